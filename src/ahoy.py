@@ -0,0 +1,225 @@
+# ahoy.py
+#
+# command queue for the /api/ctrl limit commands of the ahoy DTU
+#
+# Only the latest pending limit per inverter is kept, a new limit replaces
+# a limit which is not sent yet. A background thread sends the commands
+# with a timeout and confirms each limit by reading back power_limit_ack
+# and power_limit_read of the inverter. So a fast regulation never sends
+# more commands than the radio link of the inverter acknowledges, and a
+# hung DTU never blocks the caller.
+
+
+import os
+import time
+import logging
+import threading
+
+
+ahoy_timeout = 5          # timeout (s) of a single HTTP request
+ahoy_ack_timeout = 10     # maximum time (s) to wait for the ack of a limit
+ahoy_ack_poll = 1         # time (s) between two reads of the ack
+ahoy_ack_tolerance = 1    # tolerance (%) of the read back limit
+
+
+class LimitQueue:
+    """
+    Latest-wins queue of the limit commands, one pending limit per inverter
+    """
+    def __init__(self, url, timeout=None, ack_timeout=None, ack_poll=None):
+        self.url = url
+        self.timeout = float(os.getenv('AHOY_TIMEOUT', ahoy_timeout)) if timeout is None else timeout
+        self.ack_timeout = float(os.getenv('AHOY_ACK_TIMEOUT', ahoy_ack_timeout)) if ack_timeout is None else ack_timeout
+        self.ack_poll = ahoy_ack_poll if ack_poll is None else ack_poll
+
+        self.condition = threading.Condition()
+        self.pending = {}  # inverter -> limit
+        self.busy = False
+        self.results = {}  # inverter -> (limit, status)
+
+        # metrics
+        self.nr_queued = 0
+        self.nr_coalesced = 0
+        self.nr_sent = 0
+        self.nr_acked = 0
+        self.nr_failed = 0
+        self.ack_latencies = []
+
+        self.running = True
+        self.thread = threading.Thread(target=self._worker, daemon=True)
+        self.thread.start()
+
+
+    def set_limit(self, inverter, limit):
+        """
+        Queue a new limit (W) for an inverter, replaces a pending limit
+        """
+        with self.condition:
+            if inverter in self.pending:
+                self.nr_coalesced += 1
+                logging.debug(f'Limit {self.pending[inverter]} W for inverter {inverter} replaced by {limit} W')
+            self.pending[inverter] = limit
+            self.nr_queued += 1
+            self.condition.notify_all()
+
+
+    def wait(self, timeout=None):
+        """
+        Wait until all pending limits are sent and confirmed, returns
+        False on a timeout
+        """
+        with self.condition:
+            return self.condition.wait_for(
+                lambda: (len(self.pending) == 0) and not self.busy, timeout)
+
+
+    def result(self, inverter):
+        """
+        Return (limit, status) of the last processed limit of an inverter,
+        status is 'acked', 'sent' (no ack), 'failed' or None
+        """
+        with self.condition:
+            return self.results.get(inverter, (None, None))
+
+
+    def max_duration(self):
+        """
+        Return the maximum time (s) the worker needs for one limit: the
+        POST and the ack loop, whose requests never exceed its deadline
+        """
+        return self.timeout + self.ack_timeout
+
+
+    def metrics(self):
+        """
+        Return the queue depth and the ack latencies (s)
+        """
+        with self.condition:
+            latencies = self.ack_latencies
+            return {
+                'depth':           len(self.pending),
+                'queued':          self.nr_queued,
+                'coalesced':       self.nr_coalesced,
+                'sent':            self.nr_sent,
+                'acked':           self.nr_acked,
+                'failed':          self.nr_failed,
+                'ack_latency':     latencies[-1] if len(latencies) > 0 else None,
+                'ack_latency_avg': sum(latencies) / len(latencies) if len(latencies) > 0 else None,
+                'ack_latency_max': max(latencies) if len(latencies) > 0 else None,
+            }
+
+
+    def stop(self, timeout=None):
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+        self.thread.join(timeout)
+
+
+    def _worker(self):
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: (len(self.pending) > 0) or not self.running)
+                if not self.running:
+                    return
+                inverter, limit = self.pending.popitem()
+                self.busy = True
+
+            status = 'failed'
+            try:
+                status = self._send(inverter, limit)
+            except Exception as e:
+                logging.error(f'Limit {limit} W for inverter {inverter} failed: {e}')
+            finally:
+                with self.condition:
+                    if status == 'failed':
+                        self.nr_failed += 1
+                    self.results[inverter] = (limit, status)
+                    self.busy = False
+                    self.condition.notify_all()
+
+
+    def _send(self, inverter, limit):
+        """
+        Send a limit and wait for the ack of the inverter
+        """
+        import requests
+
+        cmd = {
+            "id":  int(inverter),
+            "cmd": 'limit_nonpersistent_absolute',
+            "val": limit,
+        }
+
+        t0 = time.monotonic()
+        try:
+            r = requests.post(f'{self.url}/api/ctrl', json=cmd, timeout=self.timeout)
+        except requests.exceptions.RequestException as e:
+            logging.error(f'Limit {limit} W for inverter {inverter} not sent: {e}')
+            return 'failed'
+
+        if r.status_code != 200:
+            logging.error(f'Status Code: {r.status_code}, Limit not set to {limit} W')
+            return 'failed'
+
+        with self.condition:
+            self.nr_sent += 1
+        logging.info(f'Set inverter Limit to {limit} W')
+
+        # read back the limit until the inverter acknowledged it, no
+        # request may run beyond the deadline
+        deadline = time.monotonic() + self.ack_timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+
+            with self.condition:
+                if not self.running:
+                    break
+                # a newer limit is waiting, do not wait for this ack
+                if inverter in self.pending:
+                    return 'sent'
+
+            if self._acked(requests, inverter, limit, min(self.timeout, remaining)):
+                latency = time.monotonic() - t0
+                with self.condition:
+                    self.nr_acked += 1
+                    self.ack_latencies.append(latency)
+                    del self.ack_latencies[:-100]
+                logging.info(f'Limit {limit} W acknowledged by inverter {inverter} after {latency:.1f} s')
+                return 'acked'
+
+            time.sleep(max(0, min(self.ack_poll, deadline - time.monotonic())))
+
+        logging.warning(f'Limit {limit} W not acknowledged by inverter {inverter}')
+        return 'sent'
+
+
+    def _acked(self, requests, inverter, limit, timeout):
+        """
+        Read back the limit of an inverter, returns True if the inverter
+        acknowledged the limit
+        """
+        try:
+            response = requests.get(f'{self.url}/api/inverter/id/{inverter}', timeout=timeout)
+        except requests.exceptions.RequestException:
+            return False
+
+        if response.status_code != 200:
+            return False
+
+        try:
+            data = response.json()
+            if (not data['power_limit_ack']) or (data['power_limit_read'] >= 65000):
+                return False
+
+            max_power = int(data['max_pwr'])
+            if max_power <= 0:
+                # the read back limit (%) cannot be compared
+                return False
+            expected = min(100, 100 * limit / max_power)
+            return abs(data['power_limit_read'] - expected) <= ahoy_ack_tolerance
+        except (ValueError, KeyError, TypeError) as e:
+            logging.debug(f'Invalid limit read back from inverter {inverter}: {e}')
+            return False
@@ -0,0 +1,274 @@
+# diagnostics.py
+#
+# profiling and memory tracking for the long-running controller
+#
+# cProfile, pstats and tracemalloc are imported only if the diagnostics
+# are used, so they cost nothing when they are off
+
+
+import os
+import io
+import glob
+import time
+import signal
+import logging
+
+
+diag_dir = 'diagnostics'   # directory for the diagnostic files
+diag_backup_count = 10     # number of diagnostic files to keep per kind
+diag_top_stats = 25        # number of entries written to each file
+
+profile_cycles = 0         # dump the profile stats every N cycles, 0 = off
+memory_cycles = 0          # dump the memory diff every N cycles, 0 = off
+
+enabled = False
+
+profiler = None
+memory_snapshot = None
+cycle_counter = 0
+file_counter = 0
+snapshot_requested = False  # set by SIGUSR1
+snapshot_pending = False    # on-demand tracing started, dump at the next cycle
+ondemand_profile = False    # profiler started by SIGUSR1
+ondemand_memory = False     # tracemalloc started by SIGUSR1
+
+
+def _filename(kind):
+    """
+    Create a new diagnostic filename and remove the oldest files
+    """
+    global file_counter
+
+    os.makedirs(diag_dir, exist_ok=True)
+    files = sorted(glob.glob(os.path.join(diag_dir, f'{kind}-*.txt')))
+    while len(files) >= diag_backup_count:
+        os.remove(files.pop(0))
+
+    t = time.time()
+    stamp = time.strftime('%Y%m%d-%H%M%S', time.localtime(t)) + f'-{int(t % 1 * 1e6):06d}'
+    file_counter += 1
+    return os.path.join(diag_dir, f'{kind}-{stamp}-{file_counter:04d}.txt')
+
+
+def _tracing():
+    """
+    Return True if tracemalloc was started by the diagnostics
+    """
+    return ondemand_memory or (enabled and (memory_cycles > 0))
+
+
+def dump_profile():
+    """
+    Write the collected cProfile stats to a file and restart the profiler
+    """
+    global profiler
+
+    if profiler is None:
+        return
+
+    import cProfile
+    import pstats
+
+    profiler.disable()
+
+    stream = io.StringIO()
+    stats = pstats.Stats(profiler, stream=stream)
+    stats.sort_stats('cumulative').print_stats(diag_top_stats)
+
+    filename = _filename('profile')
+    with open(filename, 'w') as f:
+        f.write(f'cycle: {cycle_counter}\n')
+        f.write(stream.getvalue())
+    logging.info(f'Profile stats written to {filename}')
+
+    if ondemand_profile:
+        profiler = None
+    else:
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+
+def dump_memory():
+    """
+    Write the top allocations and the difference to the last snapshot to a file
+    """
+    global memory_snapshot
+
+    if not _tracing():
+        return
+
+    import tracemalloc
+
+    snapshot = tracemalloc.take_snapshot()
+    snapshot = snapshot.filter_traces((
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+    ))
+    current, peak = tracemalloc.get_traced_memory()
+
+    filename = _filename('memory')
+    with open(filename, 'w') as f:
+        f.write(f'cycle: {cycle_counter}\n')
+        f.write(f'traced memory: {current / 1024:.1f} KiB (peak: {peak / 1024:.1f} KiB)\n\n')
+
+        if memory_snapshot is not None:
+            f.write(f'top {diag_top_stats} differences to the last snapshot:\n')
+            for stat in snapshot.compare_to(memory_snapshot, 'lineno')[:diag_top_stats]:
+                f.write(f'{stat}\n')
+            f.write('\n')
+
+        f.write(f'top {diag_top_stats} allocations:\n')
+        for stat in snapshot.statistics('lineno')[:diag_top_stats]:
+            f.write(f'{stat}\n')
+    logging.info(f'Memory stats written to {filename}')
+
+    memory_snapshot = snapshot
+
+
+def on_signal(signum, frame):
+    """
+    Request a snapshot at the end of the current cycle
+    """
+    global snapshot_requested
+
+    snapshot_requested = True
+
+
+def start_ondemand():
+    """
+    Start the profiler and tracemalloc if they are not running, returns
+    True if something was started
+    """
+    global profiler, memory_snapshot, ondemand_profile, ondemand_memory
+
+    started = False
+    if profiler is None:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+        ondemand_profile = True
+        started = True
+
+    if not _tracing():
+        import tracemalloc
+        tracemalloc.start()
+        # the baseline for the diff at the next cycle
+        memory_snapshot = tracemalloc.take_snapshot()
+        ondemand_memory = True
+        started = True
+
+    return started
+
+
+def stop_ondemand():
+    """
+    Stop the tracing which was started by a signal
+    """
+    global profiler, memory_snapshot, ondemand_profile, ondemand_memory
+
+    if ondemand_profile:
+        if profiler is not None:
+            profiler.disable()
+        profiler = None
+        ondemand_profile = False
+
+    if ondemand_memory:
+        import tracemalloc
+        tracemalloc.stop()
+        memory_snapshot = None
+        ondemand_memory = False
+
+
+def diag_init(profile=0, trace_memory=0):
+    """
+    Initialize the diagnostics. The SIGUSR1 handler is always installed,
+    the periodic dumps only if the options are set.
+    """
+    global enabled, profile_cycles, memory_cycles, profiler
+    global diag_dir, diag_backup_count
+
+    profile_cycles = profile
+    memory_cycles = trace_memory
+
+    diag_dir = os.getenv('DIAG_DIR', diag_dir)
+    diag_backup_count = int(os.getenv('DIAG_BACKUP_COUNT', diag_backup_count))
+
+    # on-demand snapshot, e.g. kill -USR1 <pid>
+    if hasattr(signal, 'SIGUSR1'):
+        signal.signal(signal.SIGUSR1, on_signal)
+
+    if (profile_cycles <= 0) and (memory_cycles <= 0):
+        return
+
+    if profile_cycles > 0:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+    if memory_cycles > 0:
+        import tracemalloc
+        tracemalloc.start()
+
+    enabled = True
+    logging.info(f'Diagnostics enabled (profile: {profile_cycles}, trace memory: {memory_cycles})')
+
+
+def diag_cycle():
+    """
+    Called at the end of each control cycle
+    """
+    global cycle_counter, snapshot_requested, snapshot_pending
+
+    cycle_counter += 1
+
+    # the on-demand dump writes all stats, a periodic dump of the same
+    # cycle would only repeat them
+    dumped = False
+    if snapshot_requested:
+        snapshot_requested = False
+        # missing tracing is started now and dumped at the next cycle
+        if start_ondemand():
+            snapshot_pending = True
+            logging.info('Diagnostics: on-demand tracing started')
+        else:
+            dump_profile()
+            dump_memory()
+            dumped = True
+    elif snapshot_pending:
+        snapshot_pending = False
+        dump_profile()
+        dump_memory()
+        stop_ondemand()
+        dumped = True
+
+    if (not enabled) or dumped:
+        return
+
+    if (profile_cycles > 0) and (cycle_counter % profile_cycles == 0):
+        dump_profile()
+    if (memory_cycles > 0) and (cycle_counter % memory_cycles == 0):
+        dump_memory()
+
+
+def diag_done():
+    """
+    Write the final stats and stop the diagnostics
+    """
+    global enabled, profiler
+
+    if snapshot_pending or enabled:
+        dump_profile()
+        dump_memory()
+    stop_ondemand()
+
+    if not enabled:
+        return
+
+    if profiler is not None:
+        profiler.disable()
+        profiler = None
+    if memory_cycles > 0:
+        import tracemalloc
+        tracemalloc.stop()
+
+    enabled = False
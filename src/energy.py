@@ -0,0 +1,235 @@
+# energy.py
+#
+# energy accounting for the grid meter and the battery
+#
+# The measured powers are integrated over the real elapsed time and
+# added to minute, hour, day and month rollups. Each level is a fixed
+# size ring buffer in a numpy .npy file (memory mapped), a row holds the
+# bucket number and the energies (Wh) of this bucket. A query for a range
+# of buckets is a single array lookup and does not touch the raw samples.
+
+
+import os, sys
+import time
+import atexit
+import logging
+
+import argparse
+
+import numpy as np
+
+
+energy_dir = 'energy'       # directory for the rollup files
+energy_max_gap = 300        # maximum time (s) between two samples to integrate
+
+# columns of the rollup rows, column 0 is the bucket number
+fields = ['grid_import', 'grid_export', 'battery_in', 'battery_out']
+
+# number of rows of the ring buffers
+levels = {
+    'minute': 7 * 24 * 60,   # 7 days
+    'hour':   2 * 366 * 24,  # 2 years
+    'day':    20 * 366,      # 20 years
+    'month':  100 * 12,      # 100 years
+}
+
+store = {}
+
+last_sample = None  # (monotonic time, meter power, battery power)
+last_flush = 0
+
+
+def bucket_of(level, t_local):
+    """
+    Return the bucket number of a local time for a level
+    """
+    if level == 'minute':
+        return int(t_local // 60)
+    elif level == 'hour':
+        return int(t_local // 3600)
+    elif level == 'day':
+        return int(t_local // 86400)
+    # months since 1970-01
+    tm = time.gmtime(t_local)
+    return (tm.tm_year - 1970) * 12 + tm.tm_mon - 1
+
+
+def bucket_label(level, bucket):
+    """
+    Return a readable label of a bucket
+    """
+    if level == 'month':
+        return f'{1970 + bucket // 12:04d}-{bucket % 12 + 1:02d}'
+    seconds = {'minute': 60, 'hour': 3600, 'day': 86400}[level]
+    fmt = {'minute': '%Y-%m-%d %H:%M', 'hour': '%Y-%m-%d %H:00', 'day': '%Y-%m-%d'}[level]
+    return time.strftime(fmt, time.gmtime(bucket * seconds))
+
+
+def local_time(t=None):
+    """
+    Return the local time in seconds since the epoch
+    """
+    if t is None:
+        t = time.time()
+    return t + time.localtime(t).tm_gmtoff
+
+
+def open_store(mode='r+'):
+    """
+    Open (and create) the rollup files
+    """
+    os.makedirs(energy_dir, exist_ok=True)
+    for level, size in levels.items():
+        filename = os.path.join(energy_dir, f'{level}.npy')
+        if not os.path.exists(filename):
+            rows = np.lib.format.open_memmap(filename, mode='w+', dtype=np.float64,
+                                             shape=(size, len(fields) + 1))
+            rows[:, 0] = -1
+            rows.flush()
+            del rows
+        store[level] = np.load(filename, mmap_mode=mode)
+
+
+def en_init():
+    """
+    Read the configuration and open the rollup files
+    """
+    global energy_dir, energy_max_gap
+
+    energy_dir = os.getenv('ENERGY_DIR', energy_dir)
+    energy_max_gap = int(os.getenv('ENERGY_MAX_GAP', energy_max_gap))
+
+    open_store()
+
+    # make sure that the rollups are written on exit
+    atexit.register(en_done)
+
+
+def en_add(t_local, energies):
+    """
+    Add the energies (Wh, same order as fields) to all rollups
+    """
+    for level, rows in store.items():
+        bucket = bucket_of(level, t_local)
+        row = rows[bucket % len(rows)]
+        if row[0] != bucket:
+            # the row contains an old bucket, start a new one
+            row[0] = bucket
+            row[1:] = 0
+        row[1:] += energies
+
+
+def en_sample(meter_power, battery_power=None):
+    """
+    Add a new sample of the measured powers (W). The powers of the last
+    sample are integrated over the elapsed time since the last sample.
+    Meter power > 0 is import from the grid, battery power > 0 is
+    discharging.
+    """
+    global last_sample, last_flush
+
+    if len(store) == 0:
+        return
+
+    now = time.monotonic()
+
+    if last_sample is not None:
+        t_prev, meter_prev, battery_prev = last_sample
+        dt = now - t_prev
+        if dt <= energy_max_gap:
+            hours = dt / 3600
+            energies = np.zeros(len(fields))
+            energies[0] = max(meter_prev, 0) * hours
+            energies[1] = max(-meter_prev, 0) * hours
+            if battery_prev is not None:
+                energies[2] = max(-battery_prev, 0) * hours
+                energies[3] = max(battery_prev, 0) * hours
+            en_add(local_time(), energies)
+        else:
+            logging.warning(f'Energy accounting: gap of {dt:.0f} s not integrated')
+
+    last_sample = (now, meter_power, battery_power)
+
+    # write the changes to the disk once a minute
+    if now - last_flush > 60:
+        en_flush()
+        last_flush = now
+
+
+def en_query(level, first, last):
+    """
+    Return the buckets first..last of a level and an array with the
+    energies (Wh) of each bucket, missing buckets are zero
+    """
+    rows = store[level]
+    buckets = np.arange(first, last + 1)
+    data = rows[buckets % len(rows)]
+    valid = data[:, 0] == buckets
+
+    energies = np.zeros((len(buckets), len(fields)))
+    energies[valid] = data[valid, 1:]
+    return buckets, energies
+
+
+def en_last(level, count):
+    """
+    Return the last count buckets of a level including the current one
+    """
+    last = bucket_of(level, local_time())
+    return en_query(level, last - count + 1, last)
+
+
+def en_today():
+    """
+    Return the energies (Wh) of today as a dictionary
+    """
+    buckets, energies = en_last('day', 1)
+    return dict(zip(fields, energies[0]))
+
+
+def en_flush():
+    """
+    Write the changes of the rollups to the disk
+    """
+    for rows in store.values():
+        rows.flush()
+
+
+def en_done():
+    en_flush()
+    store.clear()
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(
+        prog='energy',
+        description='Show the energy rollups of the zeroenergy controller')
+
+    parser.add_argument('-l', '--level', action='store',
+                    choices=list(levels.keys()), default='day',
+                    help='rollup level')
+    parser.add_argument('-n', '--count', action='store',
+                    type=int, default=30,
+                    help='number of buckets to show')
+    parser.add_argument('--dir', action='store',
+                    default=os.getenv('ENERGY_DIR', energy_dir),
+                    help='directory of the rollup files')
+
+    args = parser.parse_args()
+
+    energy_dir = args.dir
+    if not os.path.exists(os.path.join(energy_dir, 'day.npy')):
+        print(f'Error: no rollup files in {energy_dir}')
+        sys.exit(1)
+    open_store(mode='r')
+
+    t0 = time.perf_counter()
+    buckets, energies = en_last(args.level, min(args.count, levels[args.level]))
+    t1 = time.perf_counter()
+
+    print(f'{args.level:16s} ' + ' '.join(f'{f:>12s}' for f in fields))
+    for bucket, row in zip(buckets, energies):
+        print(f'{bucket_label(args.level, bucket):16s} ' + ' '.join(f'{e:12.1f}' for e in row))
+    print(f'{"total":16s} ' + ' '.join(f'{e:12.1f}' for e in energies.sum(axis=0)))
+    print(f'query time: {(t1 - t0) * 1000:.2f} ms')
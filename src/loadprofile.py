@@ -0,0 +1,408 @@
+# loadprofile.py
+#
+# time-of-day and weekday load profile for a feed-forward of the
+# battery power set
+#
+# The household load (grid power + battery output) is recorded into a
+# binary history file. A numpy table of 7 weekdays x slots per day holds
+# the sums and counts of the loads, the expected load is then a simple
+# O(1) lookup (linear interpolation between two slots). The table is
+# updated with every new sample. A background thread writes the new
+# samples in batches to the history file and once a day rebuilds the
+# table from the history and trims the file to the last PROFILE_WEEKS.
+
+
+import os, sys
+import time
+import atexit
+import logging
+import threading
+
+import argparse
+
+import numpy as np
+
+
+profile_file = 'load_history.bin'  # history file, records of (local time, load)
+profile_slot_minutes = 15          # width of the time slots
+profile_weeks = 4                  # number of weeks used for the profile
+profile_min_count = 3              # minimum number of samples for a valid slot
+feedforward_gain = 0.0             # gain of the feed-forward, 0 = off
+feedforward_max = 200              # maximum feed-forward correction (W)
+report_cycles = 120                # write the error report every N cycles
+profile_flush_samples = 120        # write the history file every N samples
+
+nr_of_slots = 24 * 60 // profile_slot_minutes
+
+# the profile table
+profile_sums = np.zeros((7, nr_of_slots))
+profile_counts = np.zeros((7, nr_of_slots))
+
+profile_lock = threading.Lock()
+file_lock = threading.RLock()  # history file and write_buffer -> file
+write_buffer = []        # samples which are not written to the history file
+worker_thread = None
+worker_event = threading.Event()
+rebuild_requested = False
+rebuild_day = None
+
+# error statistics for the report
+ff_prev = 0.0
+error_cycles = 0
+error_sum = 0.0
+error_sum_reactive = 0.0
+
+
+def local_time(t=None):
+    """
+    Return the local time in seconds since the epoch
+    """
+    if t is None:
+        t = time.time()
+    return t + time.localtime(t).tm_gmtoff
+
+
+def slot_position(t_local):
+    """
+    Return the position of a local time in the week table in units of
+    slots, Monday 00:00 is 0. Works also for numpy arrays.
+    """
+    # 1970-01-01 was a Thursday
+    return np.mod(t_local / (profile_slot_minutes * 60) + 3 * nr_of_slots,
+                  7 * nr_of_slots)
+
+
+def time_index(t_local):
+    """
+    Return the weekday (Monday = 0) and slot of a local time, works
+    also for numpy arrays
+    """
+    index = np.floor(slot_position(t_local)).astype(int)
+    return np.divmod(index, nr_of_slots)
+
+
+def interpolate(sums, counts, t_local):
+    """
+    Return the expected load for a local time, linear interpolated between
+    the centers of the two neighbouring slots, NaN if one of the slots has
+    not enough samples. Works also for numpy arrays.
+    """
+    pos = slot_position(t_local) - 0.5
+    i0 = np.floor(pos)
+    frac = pos - i0
+    i0 = i0.astype(int) % (7 * nr_of_slots)
+    i1 = (i0 + 1) % (7 * nr_of_slots)
+
+    sums = sums.ravel()
+    counts = counts.ravel()
+    with np.errstate(invalid='ignore', divide='ignore'):
+        load0 = np.where(counts[i0] >= profile_min_count, sums[i0] / counts[i0], np.nan)
+        load1 = np.where(counts[i1] >= profile_min_count, sums[i1] / counts[i1], np.nan)
+
+    return (1 - frac) * load0 + frac * load1
+
+
+def build_table(history, t_now):
+    """
+    Build the sums and counts tables from an array of (local time, load)
+    """
+    sums = np.zeros((7, nr_of_slots))
+    counts = np.zeros((7, nr_of_slots))
+
+    history = history[history[:, 0] >= t_now - profile_weeks * 7 * 86400]
+    if len(history) > 0:
+        wday, slot = time_index(history[:, 0])
+        np.add.at(sums, (wday, slot), history[:, 1])
+        np.add.at(counts, (wday, slot), 1)
+
+    return sums, counts
+
+
+def read_history(filename):
+    """
+    Read the history file, returns an array of (local time, load)
+    """
+    if not os.path.exists(filename):
+        return np.zeros((0, 2))
+
+    data = np.fromfile(filename, dtype=np.float64)
+    # ignore an incomplete last record
+    data = data[:len(data) - len(data) % 2]
+    return data.reshape(-1, 2)
+
+
+def write_history(filename, history, append=True):
+    """
+    Write an array of (local time, load) to the history file
+    """
+    mode = 'ab' if append else 'wb'
+    with open(filename, mode) as f:
+        f.write(np.asarray(history, dtype=np.float64).tobytes())
+
+
+def _flush():
+    """
+    Append the buffered samples to the history file
+    """
+    global write_buffer
+
+    with file_lock:
+        with profile_lock:
+            samples = write_buffer
+            write_buffer = []
+
+        if len(samples) > 0:
+            write_history(profile_file, samples)
+
+
+def _rebuild():
+    """
+    Rebuild the profile table from the history file and trim the file
+    """
+    t0 = time.time()
+
+    with file_lock:
+        _rebuild_table()
+
+    logging.info(f'Load profile rebuilt in {time.time() - t0:.2f} s')
+
+
+def _rebuild_table():
+    """
+    Rebuild the profile table, the file lock must be held
+    """
+    global profile_sums, profile_counts
+
+    # after the flush all samples up to now are in the file, all newer
+    # samples are collected in write_buffer
+    _flush()
+
+    history = read_history(profile_file)
+    t_now = local_time()
+    keep = history[:, 0] >= t_now - profile_weeks * 7 * 86400
+    if not np.all(keep):
+        history = history[keep]
+        tmpfile = profile_file + '.tmp'
+        write_history(tmpfile, history, append=False)
+        os.replace(tmpfile, profile_file)
+
+    sums, counts = build_table(history, t_now)
+
+    with profile_lock:
+        # add the samples which were recorded during the rebuild
+        for t_local, load in write_buffer:
+            wday, slot = time_index(t_local)
+            sums[wday, slot] += load
+            counts[wday, slot] += 1
+
+        profile_sums = sums
+        profile_counts = counts
+
+
+def _worker():
+    """
+    Background thread for the file I/O: writes the history and rebuilds
+    the profile table
+    """
+    global rebuild_requested
+
+    while True:
+        worker_event.wait()
+        worker_event.clear()
+
+        try:
+            if rebuild_requested:
+                rebuild_requested = False
+                _rebuild()
+            else:
+                _flush()
+        except Exception as e:
+            logging.error(f'Load profile: {e}')
+
+
+def lp_rebuild():
+    """
+    Request a rebuild of the profile table in the background thread
+    """
+    global worker_thread, rebuild_requested
+
+    if worker_thread is None:
+        worker_thread = threading.Thread(target=_worker, daemon=True)
+        worker_thread.start()
+
+    rebuild_requested = True
+    worker_event.set()
+
+
+def lp_init():
+    """
+    Read the configuration and build the profile table from the history
+    """
+    global profile_file, profile_weeks, feedforward_gain, feedforward_max, report_cycles
+    global profile_flush_samples, rebuild_day
+
+    profile_file = os.getenv('PROFILE_FILE', profile_file)
+    profile_weeks = int(os.getenv('PROFILE_WEEKS', profile_weeks))
+    feedforward_gain = float(os.getenv('FEEDFORWARD_GAIN', feedforward_gain))
+    feedforward_max = int(os.getenv('FEEDFORWARD_MAX', feedforward_max))
+    report_cycles = int(os.getenv('PROFILE_REPORT_CYCLES', report_cycles))
+    profile_flush_samples = int(os.getenv('PROFILE_FLUSH_SAMPLES', profile_flush_samples))
+
+    rebuild_day = time.localtime().tm_yday
+    lp_rebuild()
+
+    # make sure that the buffered samples are written on exit
+    atexit.register(lp_done)
+
+
+def lp_record(load):
+    """
+    Record a new load sample in the profile table, the sample is written
+    to the history file by the background thread
+    """
+    global rebuild_day
+
+    t_local = local_time()
+
+    wday, slot = time_index(t_local)
+    with profile_lock:
+        profile_sums[wday, slot] += load
+        profile_counts[wday, slot] += 1
+        write_buffer.append((t_local, load))
+        nr_buffered = len(write_buffer)
+
+    # rebuild once a day to drop the old samples
+    day = time.localtime().tm_yday
+    if day != rebuild_day:
+        rebuild_day = day
+        lp_rebuild()
+    elif nr_buffered >= profile_flush_samples:
+        worker_event.set()
+
+
+def lp_done():
+    """
+    Write the buffered samples to the history file
+    """
+    _flush()
+
+
+def lp_expected_load(t_local):
+    """
+    Return the expected load for a local time, None if there are not
+    enough samples for this time
+    """
+    with profile_lock:
+        load = float(interpolate(profile_sums, profile_counts, t_local))
+    if np.isnan(load):
+        return None
+    return load
+
+
+def lp_feedforward(update_cycle):
+    """
+    Return the feed-forward correction for the battery power set, this
+    is the expected change of the load until the next cycle
+    """
+    global ff_prev
+
+    # the caller reports the feed-forward which is applied by lp_applied()
+    ff_prev = 0.0
+
+    ff = 0.0
+    if feedforward_gain > 0:
+        t_local = local_time()
+        load_now = lp_expected_load(t_local)
+        load_next = lp_expected_load(t_local + update_cycle)
+        if (load_now is not None) and (load_next is not None):
+            ff = feedforward_gain * (load_next - load_now)
+            ff = max(-feedforward_max, min(feedforward_max, ff))
+
+    return ff
+
+
+def lp_applied(ff):
+    """
+    Set the feed-forward which really reached the battery power set in
+    this cycle, it is the baseline of the next lp_report()
+    """
+    global ff_prev
+
+    ff_prev = ff
+
+
+def lp_report(mp):
+    """
+    Update the error statistics with the measured grid power and write
+    a report every report_cycles cycles. Without the applied feed-forward
+    of the last cycle the grid power would have been about mp + ff_prev.
+    """
+    global error_cycles, error_sum, error_sum_reactive
+
+    error_cycles += 1
+    error_sum += abs(mp)
+    error_sum_reactive += abs(mp + ff_prev)
+
+    if error_cycles >= report_cycles:
+        error = error_sum / error_cycles
+        error_reactive = error_sum_reactive / error_cycles
+        if error_reactive > 0:
+            reduction = 100 * (1 - error / error_reactive)
+        else:
+            reduction = 0
+        logging.info(f'Load profile: mean grid error {error:.1f} W, without feed-forward {error_reactive:.1f} W ({reduction:.1f}% reduction)')
+        error_cycles = 0
+        error_sum = 0.0
+        error_sum_reactive = 0.0
+
+
+def evaluate(history, gain=1.0, train_fraction=0.75):
+    """
+    Evaluate the feed-forward on a recorded history: the profile is built
+    from the first part, the second part is replayed. The reactive error
+    is the change of the load between two samples, which the controller
+    corrects one cycle late. Returns the mean absolute errors without and
+    with the feed-forward.
+    """
+    split = int(len(history) * train_fraction)
+    if (split == 0) or (len(history) - split < 2):
+        return None, None
+
+    sums, counts = build_table(history[:split], history[split - 1, 0])
+
+    test = history[split:]
+    expected = interpolate(sums, counts, test[:, 0])
+
+    error_reactive = np.diff(test[:, 1])
+    ff = np.nan_to_num(gain * np.diff(expected))
+    ff = np.clip(ff, -feedforward_max, feedforward_max)
+    error_ff = error_reactive - ff
+
+    return np.mean(np.abs(error_reactive)), np.mean(np.abs(error_ff))
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(
+        prog='loadprofile',
+        description='Evaluate the load profile feed-forward on a recorded history')
+
+    parser.add_argument('filename', nargs='?', default=profile_file,
+                    help='history file')
+    parser.add_argument('-g', '--gain', action='store',
+                    type=float, default=1.0,
+                    help='gain of the feed-forward')
+
+    args = parser.parse_args()
+
+    history = read_history(args.filename)
+    error_reactive, error_ff = evaluate(history, gain=args.gain)
+    if error_reactive is None:
+        print('Not enough data in the history file')
+        sys.exit(1)
+
+    print(f'samples:                 {len(history)}')
+    print(f'mean error (reactive):   {error_reactive:.1f} W')
+    print(f'mean error (feedfwd):    {error_ff:.1f} W')
+    if error_reactive > 0:
+        print(f'reduction:               {100 * (1 - error_ff / error_reactive):.1f}%')
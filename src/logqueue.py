@@ -0,0 +1,158 @@
+# logqueue.py
+#
+# non-blocking logging pipeline for the control loop
+
+
+import os
+import time
+import queue
+import atexit
+import logging
+import logging.handlers
+
+
+log_format = '%(asctime)s %(levelname)s %(message)s'
+
+log_queue_size = 1000        # maximum number of pending log records
+log_max_bytes = 1024 * 1024  # rotate the log file if it is larger than this
+log_backup_count = 5         # number of rotated log files to keep
+log_rotate_when = 'midnight' # time based rotation, see TimedRotatingFileHandler
+log_queue_reserve = 100      # additional queue slots for info records and above
+
+listener = None
+quiet = False
+
+dropped_records = 0
+
+
+class SizedTimedRotatingFileHandler(logging.handlers.RotatingFileHandler):
+    """
+    RotatingFileHandler which additionally rotates the log file at
+    fixed time intervals (the same 'when' values as TimedRotatingFileHandler)
+    """
+    def __init__(self, filename, maxBytes=0, backupCount=0, when='midnight',
+                 encoding=None):
+        super().__init__(filename, maxBytes=maxBytes, backupCount=backupCount,
+                         encoding=encoding, delay=True)
+        # use the calculation of the rollover time from the timed handler
+        self.timed = logging.handlers.TimedRotatingFileHandler(
+            os.devnull, when=when, delay=True)
+        self.rolloverAt = self.timed.computeRollover(int(time.time()))
+
+
+    def shouldRollover(self, record):
+        if int(time.time()) >= self.rolloverAt:
+            return True
+        if self.maxBytes > 0:
+            return super().shouldRollover(record)
+        return False
+
+
+    def doRollover(self):
+        # a time based rollover without a backup count would truncate
+        # the log file, so keep at least one backup
+        if self.backupCount == 0:
+            self.backupCount = 1
+        super().doRollover()
+        self.rolloverAt = self.timed.computeRollover(int(time.time()))
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """
+    QueueHandler for a bounded queue, the caller never waits: if size
+    records are pending, debug records are dropped, all other records use
+    the reserved slots and are dropped only if these are full as well
+    """
+    def __init__(self, queue, size):
+        super().__init__(queue)
+        self.size = size
+
+
+    def prepare(self, record):
+        # formatting is done by the QueueListener in the background thread
+        return record
+
+
+    def enqueue(self, record):
+        global dropped_records
+
+        if (record.levelno < logging.INFO) and (self.queue.qsize() >= self.size):
+            dropped_records += 1
+            return
+
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            dropped_records += 1
+
+
+class BlockingQueueListener(logging.handlers.QueueListener):
+    """
+    QueueListener which waits for a free slot for the stop sentinel,
+    the queue may be full when the listener is stopped
+    """
+    def enqueue_sentinel(self):
+        self.queue.put(self._sentinel)
+
+
+def log_init(filename='zeroenergy.log', level=logging.INFO, quiet_mode=False):
+    """
+    Initialize the logging, all records are put into a queue and
+    formatted and written to the log file by a background thread
+    """
+    global listener, quiet
+
+    quiet = quiet_mode
+
+    max_bytes = int(os.getenv('LOG_MAX_BYTES', log_max_bytes))
+    backup_count = int(os.getenv('LOG_BACKUP_COUNT', log_backup_count))
+    rotate_when = os.getenv('LOG_ROTATE_WHEN', log_rotate_when)
+    queue_size = int(os.getenv('LOG_QUEUE_SIZE', log_queue_size))
+
+    file_handler = SizedTimedRotatingFileHandler(filename,
+                                                 maxBytes=max_bytes,
+                                                 backupCount=backup_count,
+                                                 when=rotate_when)
+    file_handler.setFormatter(logging.Formatter(log_format))
+
+    log_queue = queue.Queue(maxsize=queue_size + log_queue_reserve)
+    queue_handler = DroppingQueueHandler(log_queue, queue_size)
+
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+    root.setLevel(level)
+
+    listener = BlockingQueueListener(log_queue, file_handler,
+                                     respect_handler_level=True)
+    listener.start()
+
+    # make sure that all pending records are written on exit
+    atexit.register(log_done)
+
+
+def log_done():
+    """
+    Stop the background thread and flush all pending records
+    """
+    global listener
+
+    if listener is not None:
+        listener.stop()
+        for handler in listener.handlers:
+            handler.close()
+        listener = None
+
+        if dropped_records > 0:
+            print(f'Warning: {dropped_records} log records dropped')
+
+
+def echo(msg, level=logging.DEBUG):
+    """
+    Write a message as a log record with the given level and print it
+    to the console, in quiet mode the message is only logged
+    """
+    logging.log(level, msg)
+    if not quiet:
+        print(msg)
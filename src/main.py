@@ -4,22 +4,19 @@
 # changed by: Oliver Cordes 2024-01-29
 
 
-from dotenv import load_dotenv
 import os, sys
 import logging
 
-import requests
-
 import argparse
 
+import ahoy
+import logqueue
+from logqueue import echo
+
 __version__ = '0.99.0'
 
 inverter_limit = '.last_inverter_limit'
 
-
-# load .env file
-load_dotenv()
-
 def save_limit_to_file(limit):
     """
     Save the current limit to a file
@@ -45,6 +42,8 @@ def get_main_power():
     """
     Get the current power from the main power source    
     """
+    import requests
+
     power_type = os.getenv('MAIN_POWER')
     
     msg = 'OK'
@@ -77,6 +76,8 @@ def ahoy_get_power_limit():
     """
     Get the current power limit from the ahoy DTU server
     """
+    import requests
+
     AHOY_SERVER = os.getenv('AHOY_DTU_URL')
     INVERTER = os.getenv('AHOY_DTU_INVERTER')
 
@@ -117,40 +118,40 @@ def ahoy_get_power_limit():
 
 
 def ahoy_set_power_limit(limit):
-
+    """
+    Set the limit of the inverter, returns the status 'acked', 'sent'
+    (accepted by the DTU, not acknowledged by the inverter), 'failed' or
+    None if the limit is already set
+    """
     old_limit = load_limit_from_file()
 
     if limit == old_limit:
         msg = f'Limit is already set to {limit} W'
         logging.info(msg)
-        return False
+        return None
 
-    cmd = {
-       "id":  int(os.getenv('AHOY_DTU_INVERTER')),
-       "cmd": 'limit_nonpersistent_absolute',
-       "val": limit,
-    }
+    inverter = int(os.getenv('AHOY_DTU_INVERTER'))
 
-    AHOY_SERVER = os.getenv('AHOY_DTU_URL')
-
-    URL = f'{AHOY_SERVER}/api/ctrl'
+    # send the limit in the background, a hung DTU cannot block us
+    queue = ahoy.LimitQueue(os.getenv('AHOY_DTU_URL'))
+    queue.set_limit(inverter, limit)
 
-    #print(URL)
-    #print(cmd)
-
-    r = requests.post(URL, json=cmd)
-    
-    if r.status_code == 200:
-        msg = f'Set inverter Limit to {limit} W'
-        logging.info(msg)
+    if not queue.wait(timeout=queue.max_duration() + 1):
+        logging.error(f'Ahoy DTU is not responding, Limit not set to {limit} W')
+    queue.stop(timeout=0)
 
-        # save the limit to a file
+    _, status = queue.result(inverter)
+    if status in ['acked', 'sent']:
+        # save the limit to a file, a limit which the DTU accepted is not
+        # sent again, e.g. while the inverter is offline at night
         save_limit_to_file(limit)
-    else:
-        msg = f'Status Code: {r.status_code}, Limit not set to {limit} W'
-        logging.error(msg)
 
-    return True
+    metrics = queue.metrics()
+    logging.debug(f'Ahoy queue: {metrics}')
+    if metrics['ack_latency'] is not None:
+        logging.info(f'Ahoy ack latency: {metrics["ack_latency"]:.1f} s')
+
+    return status
 
 
 def doit(args):
@@ -164,20 +165,18 @@ def doit(args):
         mp, error_msg = get_main_power()
 
         if mp is None:
-            print('No main power defined: {error_msg}') 
+            echo(f'No main power defined: {error_msg}', logging.ERROR)
             sys.exit(1)
 
-        print(f'current power consumption: {mp} W')
-        logging.info(f'current power consumption: {mp} W')
+        echo(f'current power consumption: {mp} W', logging.INFO)
 
         power_limit, max_power = ahoy_get_power_limit()
 
         if power_limit is None:
-            print('No power limit defined: {error_msg}') 
+            echo('No power limit defined!', logging.ERROR)
             sys.exit(1)
 
-        print(f'current inverter power:    {power_limit} W  (max power: {max_power} W)')
-        logging.info(f'current inverter power: {power_limit} W  (max power: {max_power} W)')
+        echo(f'current inverter power:    {power_limit} W  (max power: {max_power} W)', logging.INFO)
 
 
         if mp > 0:
@@ -207,15 +206,17 @@ def doit(args):
                 new_limit = 0   
 
     if args.simulate:
-        print(f'Simulate new inverter limit: {new_limit} W') 
-        logging.info(f'Simulate new inverter limit: {new_limit} W')
+        echo(f'Simulate new inverter limit: {new_limit} W', logging.INFO)
     else:   
-        res = ahoy_set_power_limit(new_limit)
-        if res:
-            print(f'Set new inverter limit:    {new_limit} W') 
-            logging.info(f'Set new inverter limit: {new_limit} W')
+        status = ahoy_set_power_limit(new_limit)
+        if status == 'acked':
+            echo(f'Set new inverter limit:    {new_limit} W', logging.INFO)
+        elif status == 'sent':
+            echo(f'Sent new inverter limit:   {new_limit} W (not acknowledged by the inverter)', logging.WARNING)
+        elif status == 'failed':
+            echo(f'Inverter limit {new_limit} W could not be sent!', logging.ERROR)
         else:
-            print(f'Inverter limit is not changed!')
+            echo('Inverter limit is not changed!', logging.INFO)
 
     
 # main
@@ -244,21 +245,28 @@ if __name__ == '__main__':
     parser.add_argument('-s', '--simulate', action='store_true',
                     help='simulate the setting of the inverter limit')
     parser.add_argument('-d', '--debug', action='store_true')
+    parser.add_argument('-q', '--quiet', action='store_true',
+                    help='write the console output to the log file instead')
     parser.add_argument('--manuallimit', action='store', 
                     type=int, default=-1,
                     help="set the limit manually (W) for the inverter")     
 
     args = parser.parse_args()
 
+    # load .env file, imported here to keep --version/--help fast
+    from dotenv import load_dotenv
+    load_dotenv()
 
     if args.debug:
         level = logging.DEBUG
     else:
         level = logging.INFO
 
-    logging.basicConfig(filename='zeroenergy.log', level=level, format='%(asctime)s %(levelname)s %(message)s')
+    logqueue.log_init(filename=os.getenv('LOG_FILE', 'zeroenergy.log'),
+                      level=level, quiet_mode=args.quiet)
     logging.info('Started')
 
     doit(args)
     logging.info('Finished')
+    logqueue.log_done()
 
@@ -4,20 +4,18 @@
 # changed by: Oliver Cordes 2025-07-28
 
 
-from dotenv import load_dotenv
 import os, sys
 
 import time
 import logging
 import json
 
-import requests
-
 import argparse
 
-import numpy as np
-
-import mqtt 
+import mqtt
+import logqueue
+import diagnostics
+from logqueue import echo
 
 __author__ = 'Oliver Cordes'
 __version__ = '0.99.0'
@@ -40,36 +38,37 @@ power_high_consumption = 1000  # power consumption above this value will set the
 
 battery_zero_buffer = 10  # buffer to avoid oscillation, use more grid power
 
-battery_total_in = 0 # total power set to the battery, charging
-battery_total_out = 0  # total power set to the battery, discharging
-
 power_avg_algorithm = 'percentile'  # algorithm to use for the power averaging, 'mean', 'median', 'percentile'
 power_avg_percentile = 25  # percentile to use for the power averaging, only used if power_avg_algorithm is 'percentile'
 
-# day of today, used to reset the total power counters
-# this is used to reset the counters at midnight
-day_of_today = 0
-day_of_today_prev = 0
 
-# load .env file
-load_dotenv()
+def load_config():
+    """
+    Load the .env file and read the environment variables
+    """
+    global battery_set_max, battery_set_min, battery_set_tolerance
+    global power_high_consumption, power_avg_algorithm, power_avg_percentile
+
+    # load .env file, imported here to keep --version/--help fast
+    from dotenv import load_dotenv
+    load_dotenv()
 
-# read the environment variables
-battery_set_max = int(os.getenv('BATTERY_SET_MAX', battery_set_max))
-battery_set_min = int(os.getenv('BATTERY_SET_MIN', battery_set_min))
-battery_set_tolerance = int(os.getenv('BATTERY_SET_TOLERANCE', battery_set_tolerance))
+    # read the environment variables
+    battery_set_max = int(os.getenv('BATTERY_SET_MAX', battery_set_max))
+    battery_set_min = int(os.getenv('BATTERY_SET_MIN', battery_set_min))
+    battery_set_tolerance = int(os.getenv('BATTERY_SET_TOLERANCE', battery_set_tolerance))
 
-power_high_consumption = int(os.getenv('POWER_HIGH_CONSUMPTION', power_high_consumption))
+    power_high_consumption = int(os.getenv('POWER_HIGH_CONSUMPTION', power_high_consumption))
 
-power_avg_algorithm = os.getenv('POWER_AVG_ALGORITHM', power_avg_algorithm)
-if power_avg_algorithm not in ['mean', 'median', 'percentile']:
-    print(f'Error: Invalid POWER_AVG_ALGORITHM {power_avg_algorithm}, using mean')
-    power_avg_algorithm = 'mean'
-power_avg_percentile = int(os.getenv('POWER_AVG_PERCENTILE', power_avg_percentile)) 
-if power_avg_algorithm == 'percentile':
-    if power_avg_percentile < 0 or power_avg_percentile > 100:
-        print(f'Error: Invalid POWER_AVG_PERCENTILE {power_avg_percentile}, using 75')
-        power_avg_percentile = 75   
+    power_avg_algorithm = os.getenv('POWER_AVG_ALGORITHM', power_avg_algorithm)
+    if power_avg_algorithm not in ['mean', 'median', 'percentile']:
+        print(f'Error: Invalid POWER_AVG_ALGORITHM {power_avg_algorithm}, using mean')
+        power_avg_algorithm = 'mean'
+    power_avg_percentile = int(os.getenv('POWER_AVG_PERCENTILE', power_avg_percentile)) 
+    if power_avg_algorithm == 'percentile':
+        if power_avg_percentile < 0 or power_avg_percentile > 100:
+            print(f'Error: Invalid POWER_AVG_PERCENTILE {power_avg_percentile}, using 75')
+            power_avg_percentile = 75   
 
 
 # -------
@@ -99,10 +98,12 @@ def get_main_power():
     """
     Get the current power from the main power source    
     """
+    import requests
+
     power_type = os.getenv('MAIN_POWER')
     json_path = os.getenv('TASMOTA_PATH', 'StatusSNS.Energy.Power_cur').strip().split('.')
     if len(json_path) < 3:
-        print(f'Error: Invalid TASMOTA_PATH {os.getenv("TASMOTA_PATH")}')
+        echo(f'Error: Invalid TASMOTA_PATH {os.getenv("TASMOTA_PATH")}', logging.ERROR)
         return None, 'Invalid TASMOTA_PATH'
 
     
@@ -139,6 +140,9 @@ def get_main_power_cycle(update_cycle=30):
     """
     Get the current power from the main power source in a loop
     """
+    import numpy as np
+    import energy
+
     #print(f'Get main power every {update_cycle} seconds')
 
     nr_of_cycles = int(os.getenv('NR_POWER_READINGS', 5))
@@ -149,8 +153,9 @@ def get_main_power_cycle(update_cycle=30):
         if power is not None:
             #print(f'Current main power: {power} W')
             values.append(power)
+            energy.en_sample(power, battery_state['grid_on_p'])
         else:
-            print(msg)
+            echo(msg, logging.WARNING)
         time.sleep(small_cycle)  # wait for the next cycle
 
     #print(values)
@@ -172,8 +177,10 @@ def get_main_power_cycle(update_cycle=30):
 
 def doit(args):
     global battery_power_set, battery_power_set_prev
-    global day_of_today, day_of_today_prev
-    global battery_total_in, battery_total_out
+
+    import numpy as np
+    import loadprofile
+    import energy
 
     update_cycle = 30  # seconds
 
@@ -184,17 +191,21 @@ def doit(args):
 
     time.sleep(5)  # wait for MQTT connection to be established and messages to be received
 
-    print('doit algorithm:')
-    print(f'  BATTERY_SET_MAX:       {battery_set_max} W')
-    print(f'  BATTERY_SET_MIN:       {battery_set_min} W')
+    echo('doit algorithm:', logging.INFO)
+    echo(f'  BATTERY_SET_MAX:       {battery_set_max} W', logging.INFO)
+    echo(f'  BATTERY_SET_MIN:       {battery_set_min} W', logging.INFO)
 
     bat_grid_power = battery_state['grid_on_p']
-    print(f'  BATTERY_ON_GRID_POWER: {bat_grid_power} W')
+    echo(f'  BATTERY_ON_GRID_POWER: {bat_grid_power} W', logging.INFO)
 
-    print(f'  BATTERY_SET_TOLERANCE: {battery_set_tolerance} W')
-    print(f'  POWER_AVG_ALGORITHM:   {power_avg_algorithm}')
+    echo(f'  BATTERY_SET_TOLERANCE: {battery_set_tolerance} W', logging.INFO)
+    echo(f'  POWER_AVG_ALGORITHM:   {power_avg_algorithm}', logging.INFO)
     if power_avg_algorithm == 'percentile':
-        print(f'  POWER_AVG_PERCENTILE:  {power_avg_percentile}')
+        echo(f'  POWER_AVG_PERCENTILE:  {power_avg_percentile}', logging.INFO)
+
+    loadprofile.lp_init()
+    energy.en_init()
+    echo(f'  FEEDFORWARD_GAIN:      {loadprofile.feedforward_gain}', logging.INFO)
 
     if bat_grid_power is not None:
         battery_power_set = bat_grid_power
@@ -203,60 +214,64 @@ def doit(args):
     while True:
         # print the current time
         time_now = time.localtime()
-        print('----', time.strftime('%Y-%m-%d %H:%M:%S', time_now), '----')
-
-        day_of_today = time_now.tm_mday
-        if (day_of_today != day_of_today_prev) and (day_of_today_prev != 0):
-            # reset the total power counters at midnight
-            print(f'Resetting total power counters for today!')
-            battery_total_in = 0
-            battery_total_out = 0
-            day_of_today_prev = day_of_today
-
+        echo(f"---- {time.strftime('%Y-%m-%d %H:%M:%S', time_now)} ----")
         
         # get the current power consumption
         mp, error_msg = get_main_power_cycle(update_cycle=update_cycle)
 
         if mp is None:
-            print(f'No main power defined: {error_msg}') 
+            echo(f'No main power defined: {error_msg}', logging.ERROR)
             sys.exit(1)
 
-        print(f'current power consumption: {mp} W (avg)')
-        logging.info(f'current power consumption: {mp} W (avg)')
+        echo(f'current power consumption: {mp} W (avg)', logging.INFO)
 
         # get the current battery state
         battery_soc = battery_state['soc']
         battery_grid_power = battery_state['grid_on_p']
 
         if battery_soc is not None:
-            print(f'current battery state of charge: {battery_soc}%')
+            echo(f'current battery state of charge: {battery_soc}%', logging.INFO)
             
         
         if battery_grid_power is not None:
-            print(f'current battery grid power: {battery_grid_power} W (set: {battery_power_set} W)')
-            logging.info(f'current battery grid power: {battery_grid_power} W (set: {battery_power_set} W)')
+            echo(f'current battery grid power: {battery_grid_power} W (set: {battery_power_set} W)', logging.INFO)
         
 
         # crosscheck the battery power set with the current grid power
         if battery_grid_power is not None:
             if np.isclose(battery_grid_power, battery_power_set, atol=battery_set_tolerance) == False:
-                print(f'Battery grid power {battery_grid_power} W does not match battery power set {battery_power_set} W, updating power set')
-                logging.warning(f'Battery grid power {battery_grid_power} W does not match battery power set {battery_power_set} W, updating power set')
+                echo(f'Battery grid power {battery_grid_power} W does not match battery power set {battery_power_set} W, updating power set', logging.WARNING)
                 battery_power_set = battery_grid_power
                 battery_power_set_prev = battery_grid_power    
 
+        # record the household load for the load profile
+        if battery_grid_power is not None:
+            loadprofile.lp_record(mp + battery_grid_power)
+        loadprofile.lp_report(mp)
+
+        # expected change of the load until the next cycle
+        ff = loadprofile.lp_feedforward(update_cycle)
+        if ff != 0:
+            echo(f' feed-forward from load profile: {ff:.1f} W')
+
         # calculate the new power set
-        new_power_set = int(battery_power_set + mp)
+        new_power_set = int(battery_power_set + mp + ff)
 
-        print(f' new power set for battery: {new_power_set} W')
+        echo(f' new power set for battery: {new_power_set} W')
+
+        # the feed-forward which reaches the battery, 0 if the power set
+        # is clipped, forced to 0 or not published
+        ff_applied = ff
 
         # shaping the new power set
 
         # phase 1: check if the new power set is within the limits
         if new_power_set > battery_set_max:
             new_power_set = battery_set_max
+            ff_applied = 0
         elif new_power_set < battery_set_min:
             new_power_set = battery_set_min
+            ff_applied = 0
 
 
         #  phase 2: check if we are falling or rising
@@ -275,24 +290,24 @@ def doit(args):
 
         # phase 3: check if the power consumption is far to high
         if mp > power_high_consumption:
-            print(f' power consumption is too high, setting power set to 0 W')
-            logging.warning(f'Power consumption is too high, setting power set to 0 W')
+            echo(f' power consumption is too high, setting power set to 0 W', logging.WARNING)
             new_power_set = 0
+            ff_applied = 0
 
 
-        print(f' shaped new power set for battery: {new_power_set} W')
+        echo(f' shaped new power set for battery: {new_power_set} W')
         #if new_power_set >  0:
         #    new_power_set = 0
 
         if (new_power_set < 0) and (battery_soc is not None) and (battery_soc >= 99.9):
-            print(f' Battery is full, setting power set to 0 W')
-            logging.warning(f'Battery is full!')    
+            echo(f' Battery is full, setting power set to 0 W', logging.WARNING)
             new_power_set = 0
+            ff_applied = 0
 
         if (new_power_set > 0) and (battery_soc is not None) and (battery_soc <= 10.1):
-            print(f' Battery is empty, setting power set to 0 W')
-            logging.warning(f'Battery is empty!')    
+            echo(f' Battery is empty, setting power set to 0 W', logging.WARNING)
             new_power_set = 0
+            ff_applied = 0
 
 
         if (new_power_set != 0) or (battery_power_set != 0):
@@ -300,25 +315,31 @@ def doit(args):
             if new_power_set == battery_power_set:
                 new_power_set = new_power_set - 0.1
 
-            print(f' power set for battery: {new_power_set} W')
-            battery_power_set_prev = battery_power_set
-            battery_power_set = new_power_set
-            mqtt.mqtt_publish(mqtt_topic, str(new_power_set), qos=1)    
-                
-
-            logging.info(f'power set for battery: {new_power_set} W')
-
-            if new_power_set > 0:
-                battery_total_out += update_cycle * new_power_set / 3600
+            echo(f' power set for battery: {new_power_set} W', logging.INFO)
+            if mqtt.mqtt_publish(mqtt_topic, str(new_power_set), qos=1):
+                battery_power_set_prev = battery_power_set
+                battery_power_set = new_power_set
             else:
-                battery_total_in += update_cycle * abs(new_power_set) / 3600
-
-            logging.info(f'Total IO battery: {battery_total_in:.1f} Wh (IN), {battery_total_out:.1f} Wh (OUT), SOC: {battery_soc:.1f}%')
+                # the battery did not receive the new power set
+                echo(f' power set not published, keeping {battery_power_set} W', logging.WARNING)
+                ff_applied = 0
 
         else:
-            print(' Nothing to do, powerset for battery is zero!')
+            echo(' Nothing to do, powerset for battery is zero!', logging.INFO)
             battery_power_set_prev = 0
             battery_power_set =  0
+            ff_applied = 0
+
+        # baseline of the feed-forward report of the next cycle
+        loadprofile.lp_applied(ff_applied)
+
+        # measured energies of today
+        today = energy.en_today()
+        logging.info(f'Total IO battery: {today["battery_in"]:.1f} Wh (IN), {today["battery_out"]:.1f} Wh (OUT), SOC: {battery_soc}%')
+        logging.info(f'Total IO grid: {today["grid_import"]:.1f} Wh (IMPORT), {today["grid_export"]:.1f} Wh (EXPORT)')
+
+        # write profile and memory stats if enabled
+        diagnostics.diag_cycle()
         
 
         # wait for the next time period
@@ -363,31 +384,46 @@ if __name__ == '__main__':
                     version=f'%(prog)s {__version__} (C) 2025 Oliver Cordes',
                     help='show the version and exit')
     parser.add_argument('-d', '--debug', action='store_true')
+    parser.add_argument('-q', '--quiet', action='store_true',
+                    help='write the console output to the log file instead')
+    parser.add_argument('--profile', action='store', 
+                    type=int, default=0, metavar='N',
+                    help='write cProfile stats every N cycles')
+    parser.add_argument('--trace-memory', action='store', 
+                    type=int, default=0, metavar='N',
+                    help='write tracemalloc allocation diffs every N cycles')
     
     args = parser.parse_args()
 
+    load_config()
 
     if args.debug:
         level = logging.DEBUG
     else:
         level = logging.INFO
 
-    logging.basicConfig(filename='zeroenergy.log', level=level, format='%(asctime)s %(levelname)s %(message)s')
+    logqueue.log_init(filename=os.getenv('LOG_FILE', 'zeroenergy.log'),
+                      level=level, quiet_mode=args.quiet)
     logging.info('Started')
 
+    diagnostics.diag_init(profile=args.profile, trace_memory=args.trace_memory)
+
     mqtt.mqtt_init(os.getenv('MQTT_HOST', 'localhost'),
                    port=int(os.getenv('MQTT_PORT', 1883)))  
 
     mqtt.mqtt_subscribe("homeassistant/sensor/MSA-280024370560/quick/state", on_message, qos=1)
 
+    # the shutdown runs also after sys.exit() and exceptions, the load
+    # history and the energies are written by atexit handlers of
+    # lp_init() and en_init()
     try:
         doit(args)
     except KeyboardInterrupt as e:
         #logging.error(f'Error occurred: {e}')
         pass
-    #doit(args)
-
-    mqtt.mqtt_done()
-    logging.info('Finished')
-    print('Finished')
+    finally:
+        diagnostics.diag_done()
+        mqtt.mqtt_done()
+        echo('Finished', logging.INFO)
+        logqueue.log_done()
     sys.exit(0)
@@ -1,114 +1,343 @@
-import time
-import paho.mqtt.client as mqtt
-
-def on_publish(client, userdata, mid, reason_code, properties):
-    # reason_code and properties will only be present in MQTTv5. It's always unset in MQTTv3
-    try:
-        userdata.remove(mid)
-    except KeyError:
-        print("on_publish() is called with a mid not present in unacked_publish")
-        print("This is due to an unavoidable race-condition:")
-        print("* publish() return the mid of the message sent.")
-        print("* mid from publish() is added to unacked_publish by the main thread")
-        print("* on_publish() is called by the loop_start thread")
-        print("While unlikely (because on_publish() will be called after a network round-trip),")
-        print(" this is a race-condition that COULD happen")
-        print("")
-        print("The best solution to avoid race-condition is using the msg_info from publish()")
-        print("We could also try using a list of acknowledged mid rather than removing from pending list,")
-        print("but remember that mid could be re-used !")
-    except ValueError:
-        print("on_publish() is called with a mid not present in unacked_publish")
-        print(mid)
-        print(userdata)
-        
-
-def on_subscribe(client, userdata, mid, reason_code_list, properties):
-    # Since we subscribed only for a single channel, reason_code_list contains
-    # a single entry
-    if reason_code_list[0].is_failure:
-        print(f"Broker rejected you subscription: {reason_code_list[0]}")
-    else:
-        print(f"Broker granted the following QoS: {reason_code_list[0].value}")
-
-
-
-
-unacked_publish = set()
-
-mqttc = None
-
-
-def mqtt_init(host, port=1883, keepalive=60):
-    global mqttc, unacked_publish
-    # create an MQTT client instance
-    mqttc = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2,
-                        userdata=unacked_publish)   
-    #client_id="zeroenergy", clean_session=True, userdata=unacked_publish)
-    
-    # set the on_publish callback
-    #mqttc.on_publish = on_publish
-
-    # set the on_subscribe callback
-    mqttc.on_subscribe = on_subscribe
-    
-    mqttc.user_data_set([])
-
-
-    # connect to the MQTT broker
-    err = mqttc.connect(host, port, keepalive)
-    if err != mqtt.MQTT_ERR_SUCCESS:
-        print(f"Failed to connect to MQTT broker: {mqttc.error_string(err)}")
-        mqttc = None
+# mqtt.py
+#
+# MQTT client manager
+#
+# One MQTTManager holds one connection to a broker, several controllers
+# can share it. Each subscription has its own handler, the incoming
+# messages are routed by a topic trie, so the dispatch cost depends only
+# on the number of topic levels and not on the number of subscriptions.
+# The connection is established in the background and re-established
+# with an exponential backoff, all subscriptions are renewed after each
+# (re)connect. A message which is not published within the timeout is
+# removed from the outgoing queue, so it is not delivered late after a
+# reconnect.
+
+
+import logging
+import threading
+
+from logqueue import echo
+
+
+mqtt_reconnect_min = 1     # minimum delay (s) between reconnects
+mqtt_reconnect_max = 120   # maximum delay (s) between reconnects
+mqtt_publish_timeout = 10  # maximum time (s) to wait for a publish
+
+
+class TopicTrie:
+    """
+    Trie of topic filters (with the wildcards + and #) and their handlers
+    """
+    def __init__(self):
+        # node: {'children': {level: node}, 'handlers': [handler, ...]}
+        self.root = self._node()
+
+
+    @staticmethod
+    def _node():
+        return {'children': {}, 'handlers': []}
+
+
+    def add(self, topic_filter, handler):
+        """
+        Add a handler to a topic filter, a handler is added only once
+        """
+        node = self.root
+        for level in topic_filter.split('/'):
+            node = node['children'].setdefault(level, self._node())
+        if handler not in node['handlers']:
+            node['handlers'].append(handler)
+
+
+    def remove(self, topic_filter, handler=None):
+        """
+        Remove a handler (all handlers if None) of a topic filter, returns
+        True if the topic filter has no handlers anymore
+        """
+        path = [self.root]
+        levels = topic_filter.split('/')
+        for level in levels:
+            node = path[-1]['children'].get(level)
+            if node is None:
+                return True
+            path.append(node)
+
+        node = path[-1]
+        if handler is None:
+            node['handlers'] = []
+        elif handler in node['handlers']:
+            node['handlers'].remove(handler)
+        empty = len(node['handlers']) == 0
+
+        # remove the empty nodes
+        for level, parent in zip(reversed(levels), reversed(path[:-1])):
+            child = parent['children'][level]
+            if (len(child['handlers']) > 0) or (len(child['children']) > 0):
+                break
+            del parent['children'][level]
+
+        return empty
+
+
+    def match(self, topic):
+        """
+        Return the handlers of all topic filters which match a topic
+        """
+        handlers = []
+        levels = topic.split('/')
+        nodes = [self.root]
+        for i, level in enumerate(levels):
+            # wildcards do not match topics starting with $ (e.g. $SYS)
+            wildcards = (i > 0) or not level.startswith('$')
+            next_nodes = []
+            for node in nodes:
+                children = node['children']
+                if wildcards and ('#' in children):
+                    handlers.extend(children['#']['handlers'])
+                if level in children:
+                    next_nodes.append(children[level])
+                if wildcards and ('+' in children):
+                    next_nodes.append(children['+'])
+            nodes = next_nodes
+            if len(nodes) == 0:
+                return handlers
+
+        for node in nodes:
+            handlers.extend(node['handlers'])
+            # 'a/#' matches also 'a'
+            if '#' in node['children']:
+                handlers.extend(node['children']['#']['handlers'])
+        return handlers
+
+
+class MQTTManager:
+    """
+    Shared MQTT connection with a topic router
+    """
+    def __init__(self, host, port=1883, keepalive=60, client_id=''):
+        # paho is imported here to keep --version/--help fast
+        import paho.mqtt.client as mqtt
+
+        self.host = host
+        self.port = port
+        self.keepalive = keepalive
+
+        self.lock = threading.Lock()
+        self.trie = TopicTrie()
+        self.subscriptions = {}  # topic filter -> qos
+        self.connected = threading.Event()
+
+        self.client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2,
+                                  client_id=client_id)
+        self.client.on_connect = self._on_connect
+        self.client.on_disconnect = self._on_disconnect
+        self.client.on_subscribe = self._on_subscribe
+        self.client.on_message = self._on_message
+        self.client.reconnect_delay_set(min_delay=mqtt_reconnect_min,
+                                        max_delay=mqtt_reconnect_max)
+
+
+    def start(self):
+        """
+        Connect in the background, a failed connect is retried
+        """
+        self.client.connect_async(self.host, self.port, self.keepalive)
+        self.client.loop_start()
+
+
+    def stop(self):
+        self.client.disconnect()
+        self.client.loop_stop()
+        self.connected.clear()
+
+
+    def wait_connected(self, timeout=None):
+        return self.connected.wait(timeout)
+
+
+    def _on_connect(self, client, userdata, flags, reason_code, properties):
+        if reason_code.is_failure:
+            echo(f'Failed to connect to MQTT broker at {self.host}:{self.port}: {reason_code}', logging.ERROR)
+            return
+
+        echo(f'Connected to MQTT broker at {self.host}:{self.port}', logging.INFO)
+        self.connected.set()
+
+        # renew all subscriptions
+        with self.lock:
+            topics = list(self.subscriptions.items())
+        if len(topics) > 0:
+            client.subscribe(topics)
+            for topic, qos in topics:
+                echo(f'Subscribed to topic {topic} with QoS {qos}', logging.INFO)
+
+
+    def _on_disconnect(self, client, userdata, flags, reason_code, properties):
+        self.connected.clear()
+        if reason_code != 0:
+            echo(f'Disconnected from MQTT broker: {reason_code}, reconnecting', logging.WARNING)
+
+
+    def _on_subscribe(self, client, userdata, mid, reason_code_list, properties):
+        for reason_code in reason_code_list:
+            if reason_code.is_failure:
+                echo(f'Broker rejected the subscription: {reason_code}', logging.ERROR)
+
+
+    def _on_message(self, client, userdata, message):
+        with self.lock:
+            handlers = self.trie.match(message.topic)
+
+        for handler in handlers:
+            try:
+                handler(client, userdata, message)
+            except Exception as e:
+                logging.error(f'MQTT handler for {message.topic} failed: {e}')
+
+
+    def subscribe(self, topic, handler, qos=1):
+        """
+        Subscribe a handler to a topic filter, the handler is called with
+        (client, userdata, message)
+        """
+        with self.lock:
+            self.trie.add(topic, handler)
+            new = self.subscriptions.get(topic, -1) < qos
+            if new:
+                self.subscriptions[topic] = qos
+
+        if not new:
+            return
+        if self.connected.is_set():
+            self.client.subscribe(topic, qos=qos)
+            echo(f'Subscribed to topic {topic} with QoS {qos}', logging.INFO)
+        else:
+            # subscribed by _on_connect()
+            echo(f'Topic {topic} is subscribed when the broker is connected', logging.DEBUG)
+
+
+    def unsubscribe(self, topic, handler=None):
+        """
+        Remove a handler (all handlers if None) from a topic filter
+        """
+        with self.lock:
+            empty = self.trie.remove(topic, handler)
+            if empty:
+                self.subscriptions.pop(topic, None)
+
+        if empty and self.connected.is_set():
+            self.client.unsubscribe(topic)
+
+
+    def publish(self, topic, payload, qos=1, timeout=None):
+        """
+        Publish a message and wait until it is sent, returns False if
+        the broker is not connected or the publish failed. A message which
+        is not published within the timeout is dropped and never sent
+        again, but it may have reached the broker without an ack.
+        """
+        if not self.connected.is_set():
+            echo(f'MQTT broker not connected, message to {topic} not published', logging.WARNING)
+            return False
+
+        if timeout is None:
+            timeout = mqtt_publish_timeout
+
+        msg_info = self.client.publish(topic, payload, qos=qos)
+        try:
+            msg_info.wait_for_publish(timeout=timeout)
+        except (ValueError, RuntimeError) as e:
+            echo(f'Failed to publish to {topic}: {e}', logging.ERROR)
+            self._drop(msg_info)
+            return False
+
+        if msg_info.is_published():
+            return True
+
+        if not self._drop(msg_info):
+            # published after the timeout
+            return True
+        echo(f'Message to {topic} not published within {timeout} s, dropped', logging.WARNING)
         return False
-    else:
-        print(f"Connected to MQTT broker at {host}:{port}")
-        mqttc.loop_start()
+
+
+    def _drop(self, msg_info):
+        """
+        Remove a message from the outgoing queue of the client, so it is
+        not sent again after a reconnect. Returns False if the message is
+        not in the queue (already published). paho has no public API for
+        this, so its internal queue is used.
+        """
+        import paho.mqtt.client as mqtt
+
+        client = self.client
+        with client._out_message_mutex:
+            message = client._out_messages.pop(msg_info.mid, None)
+            if message is None:
+                return False
+            # a late ack of the message is ignored by the client
+            if message.state in (mqtt.mqtt_ms_wait_for_puback, mqtt.mqtt_ms_wait_for_pubrec,
+                                 mqtt.mqtt_ms_wait_for_pubcomp, mqtt.mqtt_ms_resend_pubrel):
+                client._inflight_messages -= 1
         return True
 
 
-def mqtt_publish(topic, payload, qos=1):
-    global mqttc, unacked_publish
-    # publish a message to the specified topic
-    if mqttc is None:
-        print("MQTT client is not initialized. Call mqtt_init() first.")
-        return
+# shared connections, one per broker
+managers = {}
+managers_lock = threading.Lock()
 
-    msg_info = mqttc.publish(topic, payload, qos=qos)
-    
-    # add the message ID to the unacked_publish set
-    #unacked_publish.add(msg_info.mid)
+mqttc = None  # the manager of mqtt_init()
 
-    #while len(unacked_publish):
-    #    time.sleep(0.1)
 
+def mqtt_manager(host, port=1883, keepalive=60):
+    """
+    Return the shared manager for a broker, create and start it if needed
+    """
+    key = (host, port)
+    with managers_lock:
+        if key not in managers:
+            manager = MQTTManager(host, port=port, keepalive=keepalive)
+            manager.start()
+            managers[key] = manager
+        return managers[key]
 
-    # Due to race-condition described above, the following way to wait for all publish is safer
-    msg_info.wait_for_publish()
-    
 
-def mqtt_subscribe(topic, callback, qos=1):
+def mqtt_init(host, port=1883, keepalive=60, timeout=5):
+    """
+    Start the default connection, returns True if the broker is connected
+    within timeout seconds. The connection is retried in the background.
+    """
     global mqttc
+
+    mqttc = mqtt_manager(host, port=port, keepalive=keepalive)
+    if not mqttc.wait_connected(timeout):
+        echo(f'MQTT broker at {host}:{port} not connected yet, retrying in the background', logging.WARNING)
+        return False
+    return True
+
+
+def mqtt_publish(topic, payload, qos=1):
     if mqttc is None:
-        print("MQTT client is not initialized. Call mqtt_init() first.")
-        return
+        echo('MQTT client is not initialized. Call mqtt_init() first.', logging.ERROR)
+        return False
 
-    # set the on_message callback
-    mqttc.on_message = callback
+    return mqttc.publish(topic, payload, qos=qos)
 
-    # subscribe to the specified topic
-    result, mid = mqttc.subscribe(topic, qos=qos)
-    if result != mqtt.MQTT_ERR_SUCCESS:
-        print(f"Failed to subscribe to topic {topic}: {mqttc.error_string(result)}")
-    else:
-        print(f"Subscribed to topic {topic} with QoS {qos}")
+
+def mqtt_subscribe(topic, callback, qos=1):
+    if mqttc is None:
+        echo('MQTT client is not initialized. Call mqtt_init() first.', logging.ERROR)
+        return
+
+    mqttc.subscribe(topic, callback, qos=qos)
 
 
-    
 def mqtt_done():
     global mqttc
-    # disconnect the MQTT client
-    if mqttc is not None:
-        mqttc.disconnect()
-        mqttc.loop_stop()
-        mqttc = None
+
+    # disconnect all MQTT clients
+    with managers_lock:
+        for manager in managers.values():
+            manager.stop()
+        managers.clear()
+    mqttc = None
@@ -0,0 +1,230 @@
+# simulate.py
+#
+# vectorized what-if simulation of the zero export algorithm of main.py
+#
+# For each step main.py reads the meter power mp and the inverter power
+# and sets the new limit:
+#
+#   mp > 0:  limit = max_limit  (MAX_VALUE, --maxpower or max_power)
+#   mp <= 0: limit = max(mp + inverter - zero, 0)
+#
+# The limit changes the inverter output of the next step:
+#
+#   inverter[t] = min(limit[t-1], pv[t])
+#   mp[t]       = load[t] - inverter[t]
+#
+# so mp + inverter - zero = load - zero does not depend on the inverter
+# and the only state is whether the last step was a max_limit step or a
+# zero export step. The next state is a function of the last state:
+# either a constant (the last state does not matter), the identity or the
+# negation. So each state is the value of the last constant step, negated
+# by the number of negation steps since then, which is computed with
+# cumulative sums for the whole trajectory at once. The zero values are
+# independent and simulated one after the other to limit the memory.
+
+
+import sys
+
+import argparse
+
+import numpy as np
+
+
+def _states(f0, f1, initial):
+    """
+    Return the states s_t = f_t(s_t-1) of the boolean functions
+    f_t(s) = f1[t] if s else f0[t], initial is s_-1
+    """
+    n = len(f0)
+    negation = f0 & ~f1
+
+    # index of the last constant step, -1 if there is none
+    last = np.where(f0 == f1, np.arange(n, dtype=np.int32), np.int32(-1))
+    np.maximum.accumulate(last, out=last)
+    valid = last >= 0
+    np.maximum(last, 0, out=last)
+
+    # value of the last constant step
+    base = np.where(valid, f0[last], initial)
+
+    # number of negations since the last constant step
+    negations = np.cumsum(negation, dtype=np.int32)
+    negations -= np.where(valid, negations[last], 0)
+    del last, valid, negation
+
+    np.bitwise_and(negations, 1, out=negations)
+    return base ^ negations.astype(bool)
+
+
+def _simulate_row(load, pv, grid_at_max, zero, max_limit, initial_limit):
+    """
+    Simulate the limits for a single zero value, grid_at_max is the
+    state function after a max_limit step (independent of zero)
+    """
+    # limit of a zero export step
+    limit_zero = load - zero
+    np.maximum(limit_zero, 0, out=limit_zero)
+
+    first = max_limit if initial_limit is None else initial_limit
+
+    # is power taken from the grid after a zero export step?
+    limit_zero_prev = np.empty_like(limit_zero)
+    limit_zero_prev[0] = first
+    limit_zero_prev[1:] = limit_zero[:-1]
+    np.minimum(limit_zero_prev, pv, out=limit_zero_prev)
+    grid_at_zero = load > limit_zero_prev
+    del limit_zero_prev
+
+    state = _states(grid_at_zero, grid_at_max, initial_limit is None)
+    del grid_at_zero
+
+    # limit = max_limit if power is taken from the grid, else limit_zero
+    limit = limit_zero
+    limit[state] = max_limit
+    del state
+
+    inverter_sim = np.empty_like(limit)
+    inverter_sim[0] = first
+    inverter_sim[1:] = limit[:-1]
+    np.minimum(inverter_sim, pv, out=inverter_sim)
+    meter_sim = load - inverter_sim
+
+    return limit, inverter_sim, meter_sim
+
+
+def _prepare(meter, inverter, max_limit):
+    meter = np.asarray(meter, dtype=np.float64)
+    pv = np.asarray(inverter, dtype=np.float64)
+    load = meter + pv
+
+    # is power taken from the grid after a max_limit step?
+    grid_at_max = load > np.minimum(max_limit, pv)
+    return load, pv, grid_at_max
+
+
+def simulate_limits(meter, inverter, zero, max_limit, initial_limit=None):
+    """
+    Simulate the limit trajectory for recorded meter and inverter powers.
+
+    meter, inverter: arrays of the recorded powers (W), the recorded load
+                     is meter + inverter, the inverter powers are used as
+                     the available PV power
+    zero:            zero value (W), a scalar or an array of zero values
+    max_limit:       limit if power is taken from the grid
+    initial_limit:   limit before the first step, None is max_limit
+
+    Returns a dictionary with arrays of shape (len(zero), n) or (n,) for
+    a scalar zero: limit, inverter and meter powers of the simulation.
+    The zero values are simulated one after the other, use
+    simulate_balance() for many zero values and long data sets.
+    """
+    load, pv, grid_at_max = _prepare(meter, inverter, max_limit)
+
+    scalar = np.ndim(zero) == 0
+    zeros = np.atleast_1d(zero)
+
+    result = {k: np.empty((len(zeros), len(load))) for k in ['limit', 'inverter', 'meter']}
+    for i, z in enumerate(zeros):
+        row = _simulate_row(load, pv, grid_at_max, float(z), max_limit, initial_limit)
+        for k, v in zip(['limit', 'inverter', 'meter'], row):
+            result[k][i] = v
+
+    if scalar:
+        result = {k: v[0] for k, v in result.items()}
+    return result
+
+
+def simulate_balance(meter, inverter, zeros, max_limit, initial_limit=None, dt=10):
+    """
+    Simulate many zero values, returns arrays with the imported, exported
+    and produced energy (Wh) for each zero value. Only one trajectory is
+    kept in memory at a time.
+    """
+    load, pv, grid_at_max = _prepare(meter, inverter, max_limit)
+
+    zeros = np.atleast_1d(zeros)
+    grid_import = np.zeros(len(zeros))
+    grid_export = np.zeros(len(zeros))
+    produced = np.zeros(len(zeros))
+    for i, z in enumerate(zeros):
+        limit, inverter_sim, meter_sim = _simulate_row(load, pv, grid_at_max, float(z),
+                                                       max_limit, initial_limit)
+        grid_import[i], grid_export[i] = energy_balance(meter_sim, dt=dt)
+        produced[i] = np.sum(inverter_sim) * dt / 3600
+
+    return grid_import, grid_export, produced
+
+
+def simulate_limits_loop(meter, inverter, zero, max_limit, initial_limit=None):
+    """
+    Step by step reference implementation of simulate_limits() for a
+    scalar zero, follows doit() of main.py
+    """
+    load = np.asarray(meter, dtype=np.float64) + np.asarray(inverter, dtype=np.float64)
+    pv = np.asarray(inverter, dtype=np.float64)
+
+    limit = np.zeros(len(load))
+    inverter_sim = np.zeros(len(load))
+    meter_sim = np.zeros(len(load))
+
+    last_limit = max_limit if initial_limit is None else initial_limit
+    for t in range(len(load)):
+        power_limit = min(last_limit, pv[t])
+        mp = load[t] - power_limit
+
+        if mp > 0:
+            new_limit = max_limit
+        else:
+            new_limit = mp + power_limit - zero
+            if new_limit < 0:
+                new_limit = 0
+
+        limit[t] = new_limit
+        inverter_sim[t] = power_limit
+        meter_sim[t] = mp
+        last_limit = new_limit
+
+    return {'limit': limit, 'inverter': inverter_sim, 'meter': meter_sim}
+
+
+def energy_balance(meter, dt=10):
+    """
+    Return the imported and exported energy (Wh) of simulated meter powers
+    along the last axis, dt is the time step (s)
+    """
+    grid_import = np.sum(np.maximum(meter, 0), axis=-1) * dt / 3600
+    grid_export = np.sum(np.maximum(-meter, 0), axis=-1) * dt / 3600
+    return grid_import, grid_export
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(
+        prog='simulate',
+        description='Simulate the zero export algorithm for recorded data')
+
+    parser.add_argument('filename',
+                    help='text file with two columns: meter power, inverter power (W)')
+    parser.add_argument('-z', '--zero', action='store', type=int, nargs='+',
+                    default=[0],
+                    help='zero values (W) to simulate')
+    parser.add_argument('-m', '--maxpower', action='store',
+                    type=int, default=600,
+                    help='maximum power (W) for the inverter')
+    parser.add_argument('--dt', action='store',
+                    type=float, default=10,
+                    help='time step (s) of the data')
+
+    args = parser.parse_args()
+
+    data = np.loadtxt(args.filename, ndmin=2)
+    if data.shape[1] < 2:
+        print('Error: the data file needs two columns')
+        sys.exit(1)
+
+    grid_import, grid_export, produced = simulate_balance(data[:, 0], data[:, 1], args.zero,
+                                                          args.maxpower, dt=args.dt)
+
+    print(f'{"zero":>8s} {"import":>12s} {"export":>12s} {"inverter":>12s}')
+    for z, gi, ge, p in zip(args.zero, grid_import, grid_export, produced):
+        print(f'{z:8d} {gi:10.1f}Wh {ge:10.1f}Wh {p:10.1f}Wh')
@@ -0,0 +1,197 @@
+# startup_bench.py
+#
+# startup time benchmark for both entry points
+#
+# - checks that the heavy modules are not imported for --version and for
+#   main.py --manuallimit N --simulate
+# - measures the import time (-X importtime) of a --version run
+# - measures the time to the first device request of main.py
+#
+# exit code 1 if a budget is exceeded, the budgets can be raised by a
+# relative margin (BENCH_MARGIN) for slow or shared machines
+
+
+import os, sys
+import re
+import json
+import time
+import statistics
+import subprocess
+import tempfile
+import threading
+
+import argparse
+
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+
+src_dir = os.path.dirname(os.path.abspath(__file__))
+
+entry_points = ['main.py', 'main_msa2.py']
+
+# modules which must not be loaded for --version
+heavy_modules = ['requests', 'numpy', 'paho', 'dotenv']
+
+# runs which must not load heavy modules: (script, arguments, modules),
+# a manual limit is only simulated, so main.py needs no requests
+light_runs = [
+    ('main.py',      ['--version'], heavy_modules),
+    ('main_msa2.py', ['--version'], heavy_modules),
+    ('main.py',      ['--manuallimit', '100', '--simulate', '--quiet'], ['requests', 'numpy', 'paho']),
+]
+
+# default budgets in ms
+import_budget = 150
+first_request_budget = 1000
+budget_margin = 0  # margin (%) added to the budgets
+
+
+first_request_time = None
+
+
+class DeviceHandler(BaseHTTPRequestHandler):
+    """
+    Fake tasmota and ahoy DTU server, records the time of the first request
+    """
+    def do_GET(self):
+        global first_request_time
+
+        if first_request_time is None:
+            first_request_time = time.perf_counter()
+
+        if self.path.startswith('/cm'):
+            data = {'StatusSNS': {'ENERGY': {'Power_cur': 100}}}
+        else:
+            data = {'ch': [[0, 0, 300]], 'max_pwr': 600,
+                    'power_limit_ack': True, 'power_limit_read': 100}
+
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+    def log_message(self, format, *args):
+        pass
+
+
+def parse_importtime(output):
+    """
+    Parse the output of -X importtime, returns the total import time (us)
+    and the names of the top-level imported packages
+    """
+    total = 0
+    modules = set()
+    for line in output.splitlines():
+        m = re.match(r'import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)', line)
+        if m is None:
+            continue
+        modules.add(m.group(4).split('.')[0])
+        if len(m.group(3)) == 1:
+            total += int(m.group(2))
+    return total, modules
+
+
+def bench_import(script, runs, script_args=('--version',)):
+    """
+    Run a script (default with --version) with -X importtime, returns
+    the median import time (ms) and the set of imported modules
+    """
+    times = []
+    modules = set()
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for i in range(runs):
+            res = subprocess.run([sys.executable, '-X', 'importtime',
+                                  os.path.join(src_dir, script)] + list(script_args),
+                                 cwd=tmpdir, capture_output=True, text=True)
+            total, modules = parse_importtime(res.stderr)
+            times.append(total / 1000)
+    return statistics.median(times), modules
+
+
+def bench_first_request(runs):
+    """
+    Run main.py --simulate against a fake device server, returns the
+    median time (ms) from the process start to the first device request
+    """
+    global first_request_time
+
+    server = HTTPServer(('127.0.0.1', 0), DeviceHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    url = f'http://127.0.0.1:{server.server_address[1]}'
+    env = dict(os.environ,
+               MAIN_POWER='tasmota', TASMOTA_URL=url,
+               AHOY_DTU_URL=url, AHOY_DTU_INVERTER='0',
+               MAX_VALUE='0', ZERO='0')
+
+    times = []
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for i in range(runs):
+            first_request_time = None
+            start = time.perf_counter()
+            subprocess.run([sys.executable, os.path.join(src_dir, 'main.py'),
+                            '--simulate', '--quiet'],
+                           cwd=tmpdir, env=env, capture_output=True)
+            if first_request_time is None:
+                print('Error: main.py did not contact the device server')
+                times.append(float('inf'))
+            else:
+                times.append((first_request_time - start) * 1000)
+
+    server.shutdown()
+    server.server_close()
+    return statistics.median(times)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(
+        prog='startup_bench',
+        description='Startup time benchmark for the zeroenergy entry points')
+
+    parser.add_argument('-n', '--runs', action='store',
+                    type=int, default=5,
+                    help='number of runs per measurement')
+    parser.add_argument('--import-budget', action='store',
+                    type=float, default=float(os.getenv('BENCH_IMPORT_BUDGET', import_budget)),
+                    help='maximum import time (ms) for --version')
+    parser.add_argument('--first-request-budget', action='store',
+                    type=float, default=float(os.getenv('BENCH_FIRST_REQUEST_BUDGET', first_request_budget)),
+                    help='maximum time (ms) to the first device request')
+    parser.add_argument('--margin', action='store',
+                    type=float, default=float(os.getenv('BENCH_MARGIN', budget_margin)),
+                    help='margin (%%) added to the budgets, e.g. for CI runners')
+
+    args = parser.parse_args()
+
+    scale = 1 + args.margin / 100
+    import_limit = args.import_budget * scale
+    first_request_limit = args.first_request_budget * scale
+
+    failed = False
+
+    for script in entry_points:
+        import_time, modules = bench_import(script, args.runs)
+        print(f'{script:12s} --version import time: {import_time:8.1f} ms (budget: {import_limit:.0f} ms)')
+        if import_time > import_limit:
+            print(f'Error: {script} exceeds the import budget')
+            failed = True
+
+    for script, script_args, modules_forbidden in light_runs:
+        import_time, modules = bench_import(script, 1, script_args)
+        eager = sorted(modules.intersection(modules_forbidden))
+        if len(eager) > 0:
+            print(f'Error: {script} {" ".join(script_args)} imports {", ".join(eager)}')
+            failed = True
+
+    first_request = bench_first_request(args.runs)
+    print(f'main.py      first device request:   {first_request:8.1f} ms (budget: {first_request_limit:.0f} ms)')
+    if first_request > first_request_limit:
+        print('Error: main.py exceeds the first request budget')
+        failed = True
+
+    sys.exit(1 if failed else 0)
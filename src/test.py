@@ -3,3 +3,247 @@
 # mainly check if all modules can be imported
 import main
 
+import main_msa2
+import logqueue
+import diagnostics
+import startup_bench
+import ahoy
+import loadprofile
+import energy
+import simulate
+
+# check the overflow of the log queue: debug records are dropped first
+import queue
+import logging
+
+log_queue = queue.Queue(maxsize=3)
+handler = logqueue.DroppingQueueHandler(log_queue, 1)
+for level in [logging.INFO, logging.DEBUG, logging.INFO, logging.WARNING, logging.ERROR]:
+    handler.handle(logging.LogRecord('test', level, __file__, 0, 'msg', None, None))
+assert [log_queue.get_nowait().levelno for i in range(3)] == [logging.INFO, logging.INFO, logging.WARNING]
+assert logqueue.dropped_records == 2
+logqueue.dropped_records = 0
+
+# check the vectorized simulation against the step by step version
+import numpy as np
+
+rng = np.random.default_rng(42)
+pv = np.clip(rng.normal(300, 200, 1000), 0, None)
+load = np.clip(rng.normal(250, 150, 1000), 0, None)
+for zero in [0, 20, 50]:
+    res = simulate.simulate_limits(load - pv, pv, zero, 600)
+    ref = simulate.simulate_limits_loop(load - pv, pv, zero, 600)
+    for key in ref:
+        assert np.allclose(res[key], ref[key]), f'simulate: {key} differs for zero={zero}'
+
+# check the topic router of the MQTT client manager
+import mqtt
+
+trie = mqtt.TopicTrie()
+trie.add('a/b/c', 'abc')
+trie.add('a/+/c', 'a+c')
+trie.add('a/#', 'a#')
+assert sorted(trie.match('a/b/c')) == ['a#', 'a+c', 'abc']
+assert trie.match('a') == ['a#']
+assert trie.match('b/c') == []
+trie.remove('a/#', 'a#')
+assert sorted(trie.match('a/x/c')) == ['a+c']
+
+# check the dispatch of the manager, no broker is needed for this
+class Message:
+    def __init__(self, topic):
+        self.topic = topic
+
+received = []
+def handler(client, userdata, message):
+    received.append(message.topic)
+def failing_handler(client, userdata, message):
+    raise ValueError('test')
+
+manager = mqtt.MQTTManager('localhost')
+manager.subscribe('sensor/+/state', handler)
+manager.subscribe('sensor/+/state', handler)  # subscribed only once
+manager.subscribe('sensor/#', failing_handler)
+manager._on_message(manager.client, None, Message('sensor/a/state'))
+assert received == ['sensor/a/state'], f'mqtt: wrong dispatch {received}'
+manager.unsubscribe('sensor/+/state', handler)
+manager._on_message(manager.client, None, Message('sensor/a/state'))
+assert received == ['sensor/a/state'], 'mqtt: handler called after unsubscribe'
+assert list(manager.subscriptions) == ['sensor/#']
+
+# a message which is not published is not sent again after a reconnect
+msg_info = manager.client.publish('sensor/set', '100', qos=1)
+assert manager._drop(msg_info) and (len(manager.client._out_messages) == 0)
+assert not manager._drop(msg_info)
+
+# check the energy rollups across a wrap of the ring buffers
+import os
+import tempfile
+
+with tempfile.TemporaryDirectory() as tmpdir:
+    os.environ['ENERGY_DIR'] = tmpdir
+    energy.en_init()
+
+    size = energy.levels['minute']
+    t0 = 1000 * 86400.0
+    energy.en_add(t0, np.array([1.0, 2.0, 3.0, 4.0]))
+    energy.en_add(t0, np.array([1.0, 0.0, 0.0, 0.0]))
+    # same row of the minute ring buffer, one wrap later
+    energy.en_add(t0 + size * 60, np.array([5.0, 0.0, 0.0, 0.0]))
+
+    first = energy.bucket_of('minute', t0)
+    buckets, values = energy.en_query('minute', first, first + 1)
+    assert np.all(values == 0), 'energy: stale bucket not zero'
+    buckets, values = energy.en_query('minute', first + size - 1, first + size)
+    assert np.all(values[0] == 0) and np.all(values[1] == [5, 0, 0, 0]), 'energy: wrapped bucket wrong'
+
+    day = energy.bucket_of('day', t0)
+    buckets, values = energy.en_query('day', day, day)
+    assert np.all(values[0] == [2, 2, 3, 4]), 'energy: day rollup wrong'
+
+    energy.en_done()
+    del os.environ['ENERGY_DIR']
+
+# check the limit queue of the ahoy DTU with a fake DTU
+import json
+import time
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class FakeDTU(BaseHTTPRequestHandler):
+    """
+    Fake ahoy DTU, each POST is slow so that new limits are coalesced
+    """
+    limits = []       # all received limits
+    bad_read = False  # answer the read back with a html page
+    max_power = 600
+
+    def do_POST(self):
+        cmd = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        time.sleep(0.2)
+        FakeDTU.limits.append(cmd['val'])
+        self.reply(json.dumps({'success': True}))
+
+
+    def do_GET(self):
+        if FakeDTU.bad_read:
+            self.reply('<html></html>')
+            return
+        limit = FakeDTU.limits[-1] if len(FakeDTU.limits) > 0 else 600
+        self.reply(json.dumps({'max_pwr': FakeDTU.max_power, 'power_limit_ack': True,
+                               'power_limit_read': 100 * limit / 600}))
+
+
+    def reply(self, text):
+        body = text.encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+    def log_message(self, format, *args):
+        pass
+
+
+server = ThreadingHTTPServer(('127.0.0.1', 0), FakeDTU)
+threading.Thread(target=server.serve_forever, daemon=True).start()
+
+queue = ahoy.LimitQueue(f'http://127.0.0.1:{server.server_address[1]}',
+                        timeout=1, ack_timeout=1, ack_poll=0.05)
+
+# coalescing: at most the first and the latest limit are sent
+for limit in range(100, 600, 50):
+    queue.set_limit(1, limit)
+assert queue.wait(timeout=queue.max_duration() * 2 + 1), 'ahoy: queue not finished'
+assert FakeDTU.limits[-1] == 550 and len(FakeDTU.limits) <= 2, f'ahoy: limits not coalesced: {FakeDTU.limits}'
+assert queue.result(1) == (550, 'acked'), f'ahoy: limit not acked: {queue.result(1)}'
+metrics = queue.metrics()
+assert metrics['coalesced'] >= 8 and metrics['acked'] == 1, f'ahoy: wrong metrics {metrics}'
+assert metrics['ack_latency'] is not None
+
+# a bad read back is not acked and does not stop the worker
+FakeDTU.bad_read = True
+queue.set_limit(1, 200)
+assert queue.wait(timeout=queue.max_duration() + 1), 'ahoy: queue hangs on a bad read back'
+assert queue.result(1) == (200, 'sent'), f'ahoy: bad read back acked: {queue.result(1)}'
+
+FakeDTU.bad_read = False
+queue.set_limit(1, 300)
+assert queue.wait(timeout=queue.max_duration() + 1), 'ahoy: worker stopped'
+assert queue.result(1) == (300, 'acked'), f'ahoy: limit not acked: {queue.result(1)}'
+
+# without the maximum power the read back cannot be checked
+FakeDTU.max_power = 0
+queue.set_limit(1, 400)
+assert queue.wait(timeout=queue.max_duration() + 1)
+assert queue.result(1) == (400, 'sent'), f'ahoy: unchecked read back acked: {queue.result(1)}'
+FakeDTU.max_power = 600
+queue.stop()
+
+# a limit which is sent but not acknowledged is saved and not sent again
+cwd = os.getcwd()
+with tempfile.TemporaryDirectory() as tmpdir:
+    os.chdir(tmpdir)
+    os.environ.update(AHOY_DTU_URL=f'http://127.0.0.1:{server.server_address[1]}',
+                      AHOY_DTU_INVERTER='1', AHOY_TIMEOUT='1', AHOY_ACK_TIMEOUT='0.5')
+    FakeDTU.bad_read = True
+    nr_limits = len(FakeDTU.limits)
+    assert main.ahoy_set_power_limit(250) == 'sent'
+    assert main.load_limit_from_file() == 250
+    assert main.ahoy_set_power_limit(250) is None
+    assert len(FakeDTU.limits) == nr_limits + 1, 'ahoy: saved limit sent again'
+    FakeDTU.bad_read = False
+    for name in ['AHOY_DTU_URL', 'AHOY_DTU_INVERTER', 'AHOY_TIMEOUT', 'AHOY_ACK_TIMEOUT']:
+        del os.environ[name]
+    os.chdir(cwd)
+
+server.shutdown()
+
+# check the periodic and the on-demand (SIGUSR1) diagnostic dumps
+import glob
+import signal
+
+with tempfile.TemporaryDirectory() as tmpdir:
+    os.environ['DIAG_DIR'] = tmpdir
+    diagnostics.diag_init(profile=2)
+
+    def count(kind):
+        return len(glob.glob(os.path.join(tmpdir, f'{kind}-*.txt')))
+
+    diagnostics.diag_cycle()
+    assert count('profile') == 0
+
+    if hasattr(signal, 'SIGUSR1'):
+        # tracemalloc is started by the signal, the periodic profile dump
+        # of the same cycle is still written
+        os.kill(os.getpid(), signal.SIGUSR1)
+        diagnostics.diag_cycle()
+        assert (count('profile') == 1) and (count('memory') == 0), 'diagnostics: periodic dump skipped'
+
+        # the on-demand dump and the tracing is stopped again
+        diagnostics.diag_cycle()
+        assert (count('profile') == 2) and (count('memory') == 1), 'diagnostics: on-demand dump missing'
+        assert not diagnostics._tracing()
+
+    diagnostics.diag_done()
+    assert diagnostics.profiler is None
+    del os.environ['DIAG_DIR']
+
+# check that the load history is written when the controller exits
+# with an error
+import sys
+import subprocess
+
+with tempfile.TemporaryDirectory() as tmpdir:
+    filename = os.path.join(tmpdir, 'load_history.bin')
+    subprocess.run([sys.executable, '-c',
+                    'import sys, loadprofile\n'
+                    'loadprofile.lp_init()\n'
+                    'loadprofile.lp_record(100)\n'
+                    'sys.exit(1)\n'],
+                   cwd=os.path.dirname(os.path.abspath(__file__)),
+                   env=dict(os.environ, PROFILE_FILE=filename))
+    history = loadprofile.read_history(filename)
+    assert (len(history) == 1) and (history[0, 1] == 100), 'loadprofile: samples lost on exit'